@@ -7,11 +7,13 @@
 # - Personality switch (Professional/Casual/Fun)
 # - Rich formatting (renders fenced code blocks)
 # - Secure password storage with bcrypt (but supports old plaintext users)
+# - Per-user/per-model rate limiting with duplicate-submit coalescing
 
 import streamlit as st
 import os
 import json
 import time
+import uuid
 from datetime import datetime
 import base64
 from io import BytesIO
@@ -32,6 +34,9 @@ from gtts import gTTS
 # Password hashing
 import bcrypt
 
+# Rate limiting / duplicate-submit coalescing
+from send_guard import SendGuard, request_key
+
 # ====== API KEY ======
 if "OPENAI_API_KEY" in st.secrets:   # Streamlit Cloud
     OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
@@ -147,6 +152,16 @@ def save_chat(username: str, chat_history):
     with open(history_path(username), "w", encoding="utf-8") as f:
         json.dump(chat_history, f, indent=2, ensure_ascii=False)
 
+# ====== Helpers: Rate limiting & request coalescing ======
+# Usernames allowed to see the send metrics panel (comma-separated).
+ADMIN_USERS = {u.strip() for u in os.getenv("NOVA_ADMIN_USERS", "").split(",") if u.strip()}
+
+@st.cache_resource
+def get_send_guard() -> SendGuard:
+    # One guard per server process, shared by every session
+    # (plain module globals are recreated on each script rerun).
+    return SendGuard()
+
 # ====== UI Theme ======
 st.markdown(
     """
@@ -255,6 +270,9 @@ st.session_state.setdefault("speak_replies", False)
 st.session_state.setdefault("memory_enabled", True)
 st.session_state.setdefault("personality", "Casual 😎")
 st.session_state.setdefault("last_tts_audio", None)
+st.session_state.setdefault("session_id", uuid.uuid4().hex)
+st.session_state.setdefault("pending_send", None)  # send whose reply is not in history yet
+st.session_state.setdefault("send_notice", None)   # message to show after the next rerun
 
 # ====== Models ======
 MODELS = {
@@ -327,6 +345,7 @@ if st.session_state["logged_in"]:
     if st.sidebar.button("🗑️ Clear Chat", use_container_width=True):
         st.session_state["chat_history"] = []
         st.session_state["conversation_started"] = False
+        st.session_state["pending_send"] = None
         save_chat(st.session_state["username"], [])
         st.rerun()
 
@@ -346,6 +365,7 @@ if st.session_state["logged_in"]:
         st.session_state["username"] = ""
         st.session_state["chat_history"] = []
         st.session_state["conversation_started"] = False
+        st.session_state["pending_send"] = None
         st.rerun()
 
     # App info
@@ -566,63 +586,121 @@ else:
             raise RuntimeError(f"TTS failed: {e}")
 
     # ====== Send Message ======
-    if send and prompt.strip():
-        st.session_state["conversation_started"] = True
-
-        # Add user message
-        st.session_state["chat_history"].append({"role": "user", "content": prompt})
-        save_chat(st.session_state["username"], st.session_state["chat_history"])
-
-        with st.spinner("🤔 Nova is thinking..."):
-            loader = st.empty()
-            loader.markdown(
-                "<div style='text-align:center;margin:20px 0;'>"
-                "<div class='loading-circle'></div>"
-                "<p style='color:#00ffcc;margin-top:10px;'>Processing your request...</p>"
-                "</div>",
-                unsafe_allow_html=True
-            )
+    def rollback_pending_send():
+        # Drop the unanswered user message so history never keeps a question without a reply
+        pending = st.session_state["pending_send"]
+        st.session_state["pending_send"] = None
+        history = st.session_state["chat_history"]
+        if pending and history and history[-1] == {"role": "user", "content": pending["prompt"]}:
+            history.pop()
+            save_chat(st.session_state["username"], history)
+
+    send_request = None
+    if st.session_state["pending_send"] is not None:
+        # The last send's run was cut short by a rerun (e.g. a double-click on Send):
+        # pick it up again instead of appending and calling upstream a second time.
+        send_request = st.session_state["pending_send"]
+        if send and prompt.strip() and prompt != send_request["prompt"]:
+            # Shown after the rerun below; the new prompt stays in the input box.
+            st.session_state["send_notice"] = "Finished your previous message first. Your new message is still in the box: press Send again."
+    elif send and prompt.strip():
+        settings = {
+            "model": st.session_state["current_model"],
+            "temperature": st.session_state["temperature"],
+            "max_tokens": st.session_state["max_tokens"],
+            "personality": st.session_state["personality"],
+            "memory_enabled": st.session_state["memory_enabled"],
+        }
+        send_request = {
+            "prompt": prompt,
+            "settings": settings,
+            "key": request_key(
+                st.session_state["session_id"],
+                {"history": st.session_state["chat_history"], "prompt": prompt, **settings},
+            ),
+        }
 
-            sys_msg = {"role": "system", "content": system_prompt(st.session_state["personality"], st.session_state["memory_enabled"], st.session_state["username"])}
+    if send_request is not None:
+        settings = send_request["settings"]
+        status, result = get_send_guard().acquire(send_request["key"], st.session_state["username"], settings["model"])
 
+        if status == "rejected":
+            rollback_pending_send()
+            st.warning(f"⏳ Slow down a little! You can send again in {int(result) + 1}s.")
+        else:
+            st.session_state["conversation_started"] = True
+            reply = result if status == "done" else None
+
+            # From here on a rerun can interrupt us at any st.* call, so the
+            # leader's slot is released on every exit path.
             try:
-                # OpenAI v1 client
-                if client is not None:
-                    response = client.chat.completions.create(
-                        model=st.session_state["current_model"],
-                        messages=[sys_msg] + st.session_state["chat_history"],
-                        max_tokens=st.session_state["max_tokens"],
-                        temperature=st.session_state["temperature"]
-                    )
-                    reply = response.choices[0].message.content
-                else:
-                    # Legacy fallback
-                    response = openai_legacy.ChatCompletion.create(
-                        model=st.session_state["current_model"],
-                        messages=[sys_msg] + st.session_state["chat_history"],
-                        max_tokens=st.session_state["max_tokens"],
-                        temperature=st.session_state["temperature"]
-                    )
-                    reply = response["choices"][0]["message"]["content"]
-
-            except Exception as e:
-                reply = f"⚠️ Sorry, I'm having trouble connecting right now. Error: {str(e)[:200]}"
-
-            loader.empty()
-
-        # Add assistant response
-        st.session_state["chat_history"].append({"role": "assistant", "content": reply})
-        save_chat(st.session_state["username"], st.session_state["chat_history"])
-
-        # Speak reply if enabled
-        if st.session_state["speak_replies"]:
-            try:
-                audio_bytes = tts_to_mp3_bytes(reply)
-                st.session_state["last_tts_audio"] = audio_bytes
-            except Exception as e:
-                st.warning(f"TTS unavailable: {e}")
+                # Add user message (only once per send, even across reruns)
+                if st.session_state["pending_send"] is None:
+                    st.session_state["pending_send"] = send_request
+                    st.session_state["chat_history"].append({"role": "user", "content": send_request["prompt"]})
+                    save_chat(st.session_state["username"], st.session_state["chat_history"])
+
+                if status == "leader":
+                    with st.spinner("🤔 Nova is thinking..."):
+                        loader = st.empty()
+                        loader.markdown(
+                            "<div style='text-align:center;margin:20px 0;'>"
+                            "<div class='loading-circle'></div>"
+                            "<p style='color:#00ffcc;margin-top:10px;'>Processing your request...</p>"
+                            "</div>",
+                            unsafe_allow_html=True
+                        )
 
-        st.rerun()
+                        sys_msg = {"role": "system", "content": system_prompt(settings["personality"], settings["memory_enabled"], st.session_state["username"])}
+
+                        try:
+                            # OpenAI v1 client
+                            if client is not None:
+                                response = client.chat.completions.create(
+                                    model=settings["model"],
+                                    messages=[sys_msg] + st.session_state["chat_history"],
+                                    max_tokens=settings["max_tokens"],
+                                    temperature=settings["temperature"]
+                                )
+                                reply = response.choices[0].message.content
+                            else:
+                                # Legacy fallback
+                                response = openai_legacy.ChatCompletion.create(
+                                    model=settings["model"],
+                                    messages=[sys_msg] + st.session_state["chat_history"],
+                                    max_tokens=settings["max_tokens"],
+                                    temperature=settings["temperature"]
+                                )
+                                reply = response["choices"][0]["message"]["content"]
+
+                        except Exception as e:
+                            reply = f"⚠️ Sorry, I'm having trouble connecting right now. Error: {str(e)[:200]}"
+
+                        loader.empty()
+            finally:
+                if status == "leader":
+                    # reply is None if we stopped before upstream (tokens are refunded);
+                    # otherwise it is kept briefly for the rerun to pick up via pending_send.
+                    get_send_guard().finish(send_request["key"], reply)
+
+            # Add assistant response
+            st.session_state["chat_history"].append({"role": "assistant", "content": reply})
+            st.session_state["pending_send"] = None
+            save_chat(st.session_state["username"], st.session_state["chat_history"])
+
+            # Speak reply if enabled
+            if st.session_state["speak_replies"]:
+                try:
+                    audio_bytes = tts_to_mp3_bytes(reply)
+                    st.session_state["last_tts_audio"] = audio_bytes
+                except Exception as e:
+                    st.warning(f"TTS unavailable: {e}")
+
+            st.rerun()
+
+    if st.session_state["send_notice"]:
+        st.info(st.session_state["send_notice"])
+        st.session_state["send_notice"] = None
 
     # Play last TTS if exists and speak_replies enabled
     if st.session_state["speak_replies"] and st.session_state.get("last_tts_audio"):
@@ -666,4 +744,18 @@ else:
         </div>
         """, unsafe_allow_html=True)
 
+# ====== Operator metrics (admins only) ======
+# Rendered last so the numbers include this run's send.
+if st.session_state["logged_in"] and st.session_state["username"] in ADMIN_USERS:
+    with st.sidebar.expander("📈 Send metrics (admin)"):
+        metrics = get_send_guard().metrics()
+        c1, c2 = st.columns(2)
+        c1.metric("Queue depth", metrics["queue_depth"])
+        c2.metric("Rejected", metrics["rejected"])
+        c1.metric("Upstream calls", metrics["upstream_calls"])
+        c2.metric("Coalesced", metrics["coalesced"])
+        st.caption(
+            "Queue depth = sends currently waiting on the upstream API. "
+            "Process-wide, all users."
+        )
 
@@ -0,0 +1,156 @@
+# ====== Nova AI Chat: send guard ======
+# Rate limiting and duplicate-submit coalescing for the chat send path.
+# Kept free of Streamlit so it can be imported and tested on its own;
+# gpt.py shares a single SendGuard across sessions via st.cache_resource.
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger("nova.send_guard")
+
+# Per user (across all models): stops one person hammering Send.
+USER_BURST = 5
+USER_REFILL_PER_SEC = 0.2        # 1 send every 5 seconds sustained
+# Per model (across all users): protects the upstream quota.
+MODEL_BURST = 30
+MODEL_REFILL_PER_SEC = 2.0
+# How long a finished reply is kept so an interrupted run can pick it up.
+RESULT_TTL_SECONDS = 60
+
+
+def request_key(session_id: str, payload: dict) -> str:
+    """
+    Identify one send within one session. The payload should hold everything
+    that shapes the reply (prior messages, prompt, model, settings), so a
+    reply is never reused for a different conversation.
+    """
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    digest = hashlib.sha256(blob.encode("utf-8")).hexdigest()
+    return f"{session_id}:{digest}"
+
+
+class TokenBucket:
+    def __init__(self, burst: int, refill_per_sec: float, now: float):
+        self.burst = float(burst)
+        self.refill_per_sec = refill_per_sec
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now: float):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.refill_per_sec)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.refill_per_sec
+
+
+class SendGuard:
+    """
+    Thread-safe limiter + in-flight registry shared by every session.
+
+    acquire() returns one of:
+    - ("leader", entry): make the upstream call, then finish(key, reply) on
+      every exit path (pass None if upstream was never called).
+    - ("done", reply): a run of this send was interrupted after upstream
+      answered; the reply is handed out once.
+    - ("rejected", retry_after): a user or model bucket is empty.
+
+    Keys are per session and Streamlit runs a session's reruns one at a
+    time, so an in-flight entry found for a key belongs to a run that
+    already stopped. It is treated as stale and taken over without
+    charging another token.
+    """
+
+    def __init__(self, clock=time.monotonic,
+                 user_burst=USER_BURST, user_refill_per_sec=USER_REFILL_PER_SEC,
+                 model_burst=MODEL_BURST, model_refill_per_sec=MODEL_REFILL_PER_SEC,
+                 result_ttl=RESULT_TTL_SECONDS):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._user_limits = (user_burst, user_refill_per_sec)
+        self._model_limits = (model_burst, model_refill_per_sec)
+        self._result_ttl = result_ttl
+        self._user_buckets = {}   # username -> TokenBucket
+        self._model_buckets = {}  # model -> TokenBucket
+        self._inflight = {}       # key -> entry
+        self._finished = {}       # key -> (reply, finished_at)
+        self._metrics = {"requests": 0, "upstream_calls": 0, "coalesced": 0, "rejected": 0}
+
+    def _bucket(self, buckets: dict, name: str, limits, now: float) -> TokenBucket:
+        bucket = buckets.get(name)
+        if bucket is None:
+            bucket = buckets[name] = TokenBucket(limits[0], limits[1], now)
+        bucket.refill(now)
+        return bucket
+
+    def _prune(self, now: float):
+        expired = [k for k, (_, at) in self._finished.items() if now - at > self._result_ttl]
+        for k in expired:
+            del self._finished[k]
+
+    def acquire(self, key: str, username: str, model: str):
+        with self._lock:
+            now = self._clock()
+            self._prune(now)
+            self._metrics["requests"] += 1
+
+            if key in self._finished:
+                self._metrics["coalesced"] += 1
+                return "done", self._finished.pop(key)[0]
+            stale = self._inflight.pop(key, None)
+            if stale is not None:
+                # Its tokens were charged and never refunded; reuse them.
+                self._metrics["coalesced"] += 1
+                self._inflight[key] = stale
+                return "leader", stale
+
+            # Take from both buckets, or from neither.
+            user_bucket = self._bucket(self._user_buckets, username, self._user_limits, now)
+            model_bucket = self._bucket(self._model_buckets, model, self._model_limits, now)
+            retry_after = max(user_bucket.retry_after(), model_bucket.retry_after())
+            if retry_after > 0:
+                self._metrics["rejected"] += 1
+                logger.info("send rejected user=%s model=%s retry_after=%.1fs", username, model, retry_after)
+                return "rejected", retry_after
+            user_bucket.tokens -= 1.0
+            model_bucket.tokens -= 1.0
+
+            entry = {"username": username, "model": model}
+            self._inflight[key] = entry
+            return "leader", entry
+
+    def finish(self, key: str, reply):
+        """
+        Publish the leader's reply. A reply of None means the run stopped
+        before calling upstream: the entry is dropped and the tokens are
+        refunded, so retrying the same send does not cost twice.
+        """
+        with self._lock:
+            entry = self._inflight.pop(key, None)
+            if entry is None:
+                return
+            now = self._clock()
+            if reply is None:
+                for buckets, name in ((self._user_buckets, entry["username"]),
+                                      (self._model_buckets, entry["model"])):
+                    bucket = buckets.get(name)
+                    if bucket is not None:
+                        bucket.refill(now)
+                        bucket.tokens = min(bucket.burst, bucket.tokens + 1.0)
+            else:
+                self._metrics["upstream_calls"] += 1
+                self._finished[key] = (reply, now)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            snapshot = dict(self._metrics)
+            # Sends that hold a slot and are waiting on upstream right now.
+            snapshot["queue_depth"] = len(self._inflight)
+        return snapshot
@@ -0,0 +1,141 @@
+import pytest
+
+from send_guard import SendGuard, TokenBucket, request_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_guard(clock, **kwargs):
+    limits = dict(user_burst=3, user_refill_per_sec=1.0,
+                  model_burst=10, model_refill_per_sec=1.0, result_ttl=30)
+    limits.update(kwargs)
+    return SendGuard(clock=clock, **limits)
+
+
+def test_bucket_refill_is_capped_at_burst():
+    bucket = TokenBucket(burst=2, refill_per_sec=0.5, now=0.0)
+    bucket.tokens = 0.0
+    bucket.refill(1.0)
+    assert bucket.tokens == pytest.approx(0.5)
+    assert bucket.retry_after() == pytest.approx(1.0)
+    bucket.refill(100.0)
+    assert bucket.tokens == 2.0
+    assert bucket.retry_after() == 0.0
+
+
+def test_user_burst_then_reject_with_retry_after_then_refill():
+    clock = FakeClock()
+    guard = make_guard(clock)
+    for i in range(3):
+        assert guard.acquire(f"k{i}", "alice", "gpt-4o")[0] == "leader"
+    status, retry_after = guard.acquire("k3", "alice", "gpt-4o")
+    assert status == "rejected"
+    assert retry_after == pytest.approx(1.0)
+
+    clock.now += 1.0
+    assert guard.acquire("k3", "alice", "gpt-4o")[0] == "leader"
+
+
+def test_switching_models_does_not_bypass_user_limit():
+    guard = make_guard(FakeClock())
+    for i, model in enumerate(["a", "b", "c"]):
+        assert guard.acquire(f"k{i}", "alice", model)[0] == "leader"
+    assert guard.acquire("k3", "alice", "d")[0] == "rejected"
+
+
+def test_model_limit_applies_across_users():
+    guard = make_guard(FakeClock(), model_burst=2)
+    assert guard.acquire("k0", "alice", "gpt-4o")[0] == "leader"
+    assert guard.acquire("k1", "bob", "gpt-4o")[0] == "leader"
+    assert guard.acquire("k2", "carol", "gpt-4o")[0] == "rejected"
+    assert guard.acquire("k3", "carol", "gpt-4o-mini")[0] == "leader"
+
+
+def test_rejection_takes_no_token_from_either_bucket():
+    guard = make_guard(FakeClock(), user_burst=5, model_burst=1)
+    assert guard.acquire("k0", "alice", "m")[0] == "leader"
+    # Model bucket empty: alice's user token must not be spent.
+    for i in range(3):
+        assert guard.acquire(f"r{i}", "alice", "m")[0] == "rejected"
+    for i in range(4):
+        assert guard.acquire(f"o{i}", "alice", f"other{i}")[0] == "leader"
+
+
+def test_stale_in_flight_entry_is_taken_over_without_a_second_token():
+    guard = make_guard(FakeClock(), user_burst=1)
+    status, entry = guard.acquire("k", "alice", "m")
+    assert status == "leader"
+    # The run holding "k" stopped without calling finish(); the rerun takes over.
+    status, same = guard.acquire("k", "alice", "m")
+    assert status == "leader"
+    assert same is entry
+    assert guard.metrics()["coalesced"] == 1
+    assert guard.metrics()["queue_depth"] == 1
+
+
+def test_finished_reply_is_handed_out_once():
+    guard = make_guard(FakeClock(), user_burst=2)
+    guard.acquire("k", "alice", "m")
+    guard.finish("k", "hello")
+    assert guard.acquire("k", "alice", "m") == ("done", "hello")
+    # Resending the same prompt later (e.g. after Clear Chat) gets a fresh answer.
+    assert guard.acquire("k", "alice", "m")[0] == "leader"
+
+
+def test_finished_reply_expires_after_ttl():
+    clock = FakeClock()
+    guard = make_guard(clock)
+    guard.acquire("k", "alice", "m")
+    guard.finish("k", "hello")
+    clock.now += 31
+    assert guard.acquire("k", "alice", "m")[0] == "leader"
+
+
+def test_finish_without_reply_refunds_tokens():
+    guard = make_guard(FakeClock(), user_burst=1)
+    guard.acquire("k", "alice", "m")
+    guard.finish("k", None)
+    assert guard.metrics()["queue_depth"] == 0
+    assert guard.acquire("k", "alice", "m")[0] == "leader"
+    assert guard.metrics()["upstream_calls"] == 0
+
+
+def test_leader_abandoned_before_finishing_releases_its_slot():
+    # Mirrors gpt.py: a rerun exception raised between acquire() and the
+    # upstream call must still reach finish(key, None).
+    class Rerun(BaseException):
+        pass
+
+    guard = make_guard(FakeClock(), user_burst=1, model_burst=1)
+    with pytest.raises(Rerun):
+        status, _ = guard.acquire("k", "alice", "m")
+        reply = None
+        try:
+            raise Rerun()
+        finally:
+            guard.finish("k", reply)
+
+    assert guard.metrics()["queue_depth"] == 0
+    assert guard.acquire("other", "alice", "m")[0] == "leader"
+
+
+def test_upstream_calls_count_only_finished_replies():
+    guard = make_guard(FakeClock())
+    guard.acquire("a", "alice", "m")
+    guard.acquire("b", "alice", "m")
+    guard.finish("a", "hi")
+    guard.finish("b", None)
+    assert guard.metrics()["upstream_calls"] == 1
+
+
+def test_request_key_separates_sessions_and_payloads():
+    payload = {"prompt": "hi", "history": [], "model": "m"}
+    assert request_key("s1", payload) == request_key("s1", dict(payload))
+    assert request_key("s1", payload) != request_key("s2", payload)
+    assert request_key("s1", payload) != request_key("s1", {**payload, "history": [{"role": "user", "content": "x"}]})